@@ -1,17 +1,19 @@
+import functools
+import io
 import os
 import shutil
+import tempfile
 import uuid
 import traceback
 import pandas as pd
 import numpy as np
 from flask import Flask, request, send_file, jsonify
 from flask_cors import CORS
-from pylatex import (Document, Section, Subsection, Command, Figure, 
-                     NoEscape, Table, Tabular, TikZ, Axis, Plot, Package,
-                     PageStyle, Head, Foot, StandAloneGraphic)
-from PIL import Image, ImageDraw
+from werkzeug.exceptions import RequestEntityTooLarge
 
 app = Flask(__name__)
+# Reject oversized uploads before they are read (Flask answers 413)
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 # Allow CORS for all domains to prevent browser blocking
 CORS(app, resources={r"/*": {"origins": "*"}})
 
@@ -25,19 +27,21 @@ class BeamAnalyzer:
         # Determine Mode based on columns
         self.mode = self._determine_mode()
         
+        # Ensure sorted by position; skip the copy if the file already is
+        col = 'Position (m)' if self.mode == 'CALCULATE' else 'x'
+        if not self.df[col].is_monotonic_increasing:
+            self.df = self.df.sort_values(by=col, kind='mergesort', ignore_index=True)
+
         if self.mode == 'CALCULATE':
-            # Ensure sorted by position for calculation
-            self.df = self.df.sort_values(by='Position (m)')
             self.results = self._analyze_loads()
         else:
             # Direct Plotting Mode (User provided results)
-            self.df = self.df.sort_values(by='x')
             self.results = self._process_existing_results()
 
     def _determine_mode(self):
         # Check if we have result columns (x, shear, moment)
-        cols = [c.lower() for c in self.df.columns]
-        if 'shear' in cols and 'moment' in cols:
+        cols = set(map(str.lower, self.df.columns))
+        if {'shear', 'moment'}.issubset(cols):
             return 'PLOT_ONLY'
         return 'CALCULATE'
 
@@ -58,46 +62,37 @@ class BeamAnalyzer:
              max_pos = self.df['Position (m)'].max()
              length = max(10.0, max_pos + 1.0)
 
-        sum_moments = 0
-        sum_forces = 0
-        
-        for index, row in self.df.iterrows():
-            pos = row['Position (m)']
-            load = row['Load (kN)']
-            sum_moments += load * pos
-            sum_forces += load
-            
+        # Pull the load columns out once as plain arrays (avoids iterrows)
+        p_loc = self.df['Position (m)'].to_numpy(dtype=float)
+        p_val = self.df['Load (kN)'].to_numpy(dtype=float)
+
+        # Loads are sorted by position (see __init__), so shear and moment are
+        # piecewise linear with breakpoints at the loads. Running totals of
+        # P and P*a (with a leading 0 for "no loads yet") give them in closed form.
+        cum_load = np.concatenate(([0.0], np.cumsum(p_val)))
+        cum_load_x = np.concatenate(([0.0], np.cumsum(p_val * p_loc)))
+
+        sum_moments = cum_load_x[-1]
+        sum_forces = cum_load[-1]
+
         r_b = sum_moments / length
         r_a = sum_forces - r_b
         
-        x_coords = np.linspace(0, length, 500)
-        key_points = self.df['Position (m)'].values
-        
-        if len(key_points) > 0:
-            x_coords = np.unique(np.concatenate((x_coords, key_points, key_points - 1e-6, key_points + 1e-6)))
-        
-        x_coords = x_coords[(x_coords >= 0) & (x_coords <= length)]
-        x_coords.sort()
-        
-        shear_forces = []
-        bending_moments = []
-        
-        for x in x_coords:
-            v = r_a
-            m = r_a * x
-            for index, row in self.df.iterrows():
-                p_loc = row['Position (m)']
-                p_val = row['Load (kN)']
-                if p_loc < x:
-                    v -= p_val
-                    m -= p_val * (x - p_loc)
-            shear_forces.append(v)
-            bending_moments.append(m)
-            
+        # Between loads shear is constant and moment linear, so the diagrams
+        # are exact with just the ends and each load position +/- epsilon.
+        # np.unique sorts, so no separate sort is needed.
+        x_coords = np.concatenate(([0.0, length], p_loc - 1e-6, p_loc + 1e-6))
+        x_coords = np.unique(x_coords[(x_coords >= 0) & (x_coords <= length)])
+
+        # k[i] = number of loads strictly left of x_coords[i]
+        k = np.searchsorted(p_loc, x_coords, side='left')
+        shear_forces = r_a - cum_load[k]
+        bending_moments = r_a * x_coords - (cum_load[k] * x_coords - cum_load_x[k])
+
         return {
             'x': x_coords,
-            'shear': np.array(shear_forces),
-            'moment': np.array(bending_moments),
+            'shear': shear_forces,
+            'moment': bending_moments,
             'R_A': r_a,
             'R_B': r_b
         }
@@ -107,68 +102,133 @@ class BeamAnalyzer:
 # ==========================================
 
 def create_default_image(image_path):
-    img = Image.new('RGB', (600, 200), color='white')
+    # Imported here so PIL is only loaded when the image actually has to be drawn
+    from PIL import Image, ImageDraw
+
+    # Black-and-white line drawing: 8-bit grayscale keeps the light-gray beam
+    # fill while storing a third of the bytes of RGB
+    img = Image.new('L', (600, 200), color=255)
     d = ImageDraw.Draw(img)
-    d.rectangle([50, 90, 550, 110], fill='lightgray', outline='black')
-    d.polygon([(50, 110), (40, 130), (60, 130)], fill='black') 
-    d.ellipse([(540, 125), (560, 135)], fill='black') 
-    d.text((200, 50), "Simply Supported Beam (Default)", fill='black')
-    img.save(image_path)
+    d.rectangle([50, 90, 550, 110], fill=211, outline=0)  # 211 = lightgray
+    d.polygon([(50, 110), (40, 130), (60, 130)], fill=0) 
+    d.ellipse([(540, 125), (560, 135)], fill=0) 
+    d.text((200, 50), "Simply Supported Beam (Default)", fill=0)
+    # Write to a temp file beside the target and swap it in, so a reader
+    # (another worker's pdflatex) never sees a half-written PNG
+    fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(image_path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format='PNG', optimize=True)
+        os.replace(tmp_path, image_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
     return image_path
 
+@functools.lru_cache(maxsize=None)
+def default_image_path():
+    """Draws the default schematic on first use and returns its shared path.
+
+    The image never changes, so each process draws it once and every request
+    without an uploaded image reuses the same read-only file.
+    """
+    os.makedirs(app.static_folder, exist_ok=True)
+    return create_default_image(os.path.join(app.static_folder, 'default_beam.png'))
+
+class ColumnClashError(ValueError):
+    """Several uploaded headers end up under the same analyzer column name."""
+
+def map_columns(columns):
+    """Works out which (stripped) headers map onto the analyzer's column names."""
+    column_map = {}
+    found = set()
+    # Lowercase each header once, keeping every column in its original order
+    # (headers differing only by case must not collapse, first match wins)
+    lowered = [(c.lower(), c) for c in columns]
+    lower_names = {lower for lower, _ in lowered}
+
+    # Case A: User uploaded Results (x, shear, moment) - matches your uploaded file
+    if any(c in lower_names for c in ['shear force', 'shear', 'v']):
+        for lower, col in lowered:
+            if 'x' not in found and lower in ['x', 'pos', 'distance']:
+                column_map[col] = 'x'
+                found.add('x')
+            if 'shear' not in found and 'shear' in lower:
+                column_map[col] = 'shear'
+                found.add('shear')
+            if 'moment' not in found and 'moment' in lower:
+                column_map[col] = 'moment'
+                found.add('moment')
+
+    # Case B: User uploaded Loads (Position, Load) - matches original requirement
+    else:
+        for lower, col in lowered:
+            if 'shear' in lower:
+                continue
+            if 'pos' not in found and any(x in lower for x in ['pos', 'loc', 'dist', 'x (m)']):
+                column_map[col] = 'Position (m)'
+                found.add('pos')
+            elif 'load' not in found and any(x in lower for x in ['load', 'force', 'weight', 'p (kn)']):
+                column_map[col] = 'Load (kN)'
+                found.add('load')
+
+    return column_map
+
+# Leading bytes of the spreadsheet formats; anything else is read as CSV
+XLSX_MAGIC = b'PK\x03\x04'        # zip container (xlsx)
+XLS_MAGIC = b'\xd0\xcf\x11\xe0'    # OLE2 compound file (legacy xls)
+
 def load_data(filepath):
     try:
-        # 1. Determine file type and read
-        if filepath.endswith('.csv'):
-            df = pd.read_csv(filepath)
-        else:
+        # 1. Determine file type from its content (upload names can't be trusted) and read
+        with open(filepath, 'rb') as f:
+            head = f.read(8)
+
+        if head.startswith(XLSX_MAGIC):
+            df = pd.read_excel(filepath, engine='openpyxl')
+            column_map = None
+        elif head.startswith(XLS_MAGIC):
             df = pd.read_excel(filepath)
+            column_map = None
+        else:
+            # Peek at the header only, so the numeric columns we recognise can
+            # be parsed straight to float64 instead of going through inference
+            header = pd.read_csv(filepath, nrows=0)
+            column_map = map_columns(header.columns.str.strip())
+            dtype_map = {raw: 'float64' for raw in header.columns
+                         if raw.strip() in column_map}
+            try:
+                df = pd.read_csv(filepath, dtype=dtype_map, engine='c')
+            except ValueError:
+                # A stray non-numeric token; read with inference instead so
+                # the route can report which column is at fault
+                df = pd.read_csv(filepath, engine='c')
             
         # 2. Normalize headers
         df.columns = df.columns.str.strip()
         
         # 3. Smart Mapping
-        column_map = {}
-        original_cols = [c.lower() for c in df.columns]
-
-        # Case A: User uploaded Results (x, shear, moment) - matches your uploaded file
-        if any(c in original_cols for c in ['shear force', 'shear', 'v']):
-             # Map X
-             for col in df.columns:
-                 if col.lower() in ['x', 'pos', 'distance']: 
-                     column_map[col] = 'x'
-                     break
-             # Map Shear
-             for col in df.columns:
-                 if 'shear' in col.lower():
-                     column_map[col] = 'shear'
-                     break
-             # Map Moment
-             for col in df.columns:
-                 if 'moment' in col.lower():
-                     column_map[col] = 'moment'
-                     break
-
-        # Case B: User uploaded Loads (Position, Load) - matches original requirement
-        else:
-            for col in df.columns:
-                lower = col.lower()
-                if any(x in lower for x in ['pos', 'loc', 'dist', 'x (m)']) and 'shear' not in lower:
-                    column_map[col] = 'Position (m)'
-                    break
-            
-            for col in df.columns:
-                lower = col.lower()
-                if col in column_map: continue
-                if any(x in lower for x in ['load', 'force', 'weight', 'p (kn)']) and 'shear' not in lower:
-                    column_map[col] = 'Load (kN)'
-                    break
+        if column_map is None:
+            column_map = map_columns(df.columns)
         
+        # Headers that differ only by case (e.g. 'X' and 'x') can land on the
+        # same name after mapping; df[name] would then be a DataFrame
+        targets = {}
+        for col in df.columns:
+            targets.setdefault(column_map.get(col, col), []).append(col)
+        clashes = {name: cols for name, cols in targets.items() if len(cols) > 1}
+        if clashes:
+            details = "; ".join(f"[{', '.join(cols)}] -> '{name}'" for name, cols in clashes.items())
+            raise ColumnClashError(f"Several columns map to the same field: {details}. "
+                                   "Remove or rename the duplicates.")
+
         if column_map:
             print(f"Smart Mapping found: {column_map}")
             df = df.rename(columns=column_map)
             
         return df
+    except ColumnClashError:
+        raise  # reported to the user by the route
     except Exception as e:
         print(f"Error reading file: {e}")
         return pd.DataFrame()
@@ -177,22 +237,42 @@ def load_data(filepath):
 # PART 3: PDF GENERATOR
 # ==========================================
 
+def tikz_coords(x, y):
+    """Formats paired arrays as a pgfplots coordinate string '(x,y) (x,y) ...'."""
+    buf = io.StringIO()
+    np.savetxt(buf, np.column_stack([x, y]), fmt='(%.3f,%.3f)', newline=' ')
+    return buf.getvalue()
+
+@functools.lru_cache(maxsize=None)
+def beam_report_class():
+    """Builds the BeamReport Document subclass on first use (pylatex is imported lazily)."""
+    from pylatex import Document, Package, Command, NoEscape
+
+    class BeamReport(Document):
+        """Report shell with the fixed packages, preamble and title baked in."""
+
+        def __init__(self):
+            super().__init__(geometry_options={"tmargin": "1in", "lmargin": "1in"})
+
+            self.packages.append(Package('booktabs'))
+            self.packages.append(Package('pgfplots'))
+            self.packages.append(Package('float'))
+            self.preamble.append(NoEscape(r'\pgfplotsset{compat=1.18}'))
+
+            self.preamble.append(Command('title', 'Structural Analysis Report'))
+            self.preamble.append(Command('author', 'Automated Beam Analyzer'))
+            self.preamble.append(Command('date', NoEscape(r'\today')))
+            self.append(NoEscape(r'\maketitle'))
+
+    return BeamReport
+
 def generate_pdf_doc(df, analysis_results, image_path, filename):
-    geometry_options = {"tmargin": "1in", "lmargin": "1in"}
-    doc = Document(geometry_options=geometry_options)
-    
-    doc.packages.append(Package('booktabs'))
-    doc.packages.append(Package('pgfplots'))
-    doc.packages.append(Package('float'))
-    doc.preamble.append(NoEscape(r'\pgfplotsset{compat=1.18}'))
-    
-    doc.preamble.append(Command('title', 'Structural Analysis Report'))
-    doc.preamble.append(Command('author', 'Automated Beam Analyzer'))
-    doc.preamble.append(Command('date', NoEscape(r'\today')))
-    doc.append(NoEscape(r'\maketitle'))
-    
-    doc.append(NoEscape(r'\tableofcontents'))
-    doc.append(NoEscape(r'\newpage'))
+    # pylatex is only needed here, so it is imported on the first report
+    from pylatex import (Section, Subsection, Figure, NoEscape, Table,
+                         Tabular, TikZ, Axis)
+
+    BeamReport = beam_report_class()
+    doc = BeamReport()
 
     with doc.create(Section('Introduction')):
         doc.append("This report presents the structural analysis of a simply supported beam.")
@@ -211,16 +291,12 @@ def generate_pdf_doc(df, analysis_results, image_path, filename):
                 # Header
                 tabular.add_row(list(df.columns))
                 tabular.add_hline()
+                # Pick a formatter per column once: floats nicely, strings alone
+                fmts = ['{:.2f}'.format if pd.api.types.is_numeric_dtype(dt) else str
+                        for dt in df.dtypes]
                 # Rows (Limit to first 30 rows to prevent PDF overflow if result file is huge)
-                for index, row in df.head(30).iterrows():
-                    # Format floats nicely, leave strings alone
-                    formatted_row = []
-                    for val in row:
-                        if isinstance(val, (float, int)):
-                            formatted_row.append(f"{val:.2f}")
-                        else:
-                            formatted_row.append(str(val))
-                    tabular.add_row(formatted_row)
+                for row in df.head(30).itertuples(index=False, name=None):
+                    tabular.add_row([f(val) for f, val in zip(fmts, row)])
             table.add_caption('Provided Data')
 
     with doc.create(Section('Analysis')):
@@ -233,9 +309,8 @@ def generate_pdf_doc(df, analysis_results, image_path, filename):
                     x_clean = analysis_results['x'][valid_indices]
                     y_clean = analysis_results['shear'][valid_indices]
                     
-                    coords = [f"({x:.3f},{y:.3f})" for x, y in zip(x_clean, y_clean)]
                     # Use a simpler plot command if too many points, but closedcycle is nice
-                    plot.append(NoEscape(r'\addplot[draw=blue, fill=blue!30, thick] coordinates {' + " ".join(coords) + r'} \closedcycle;'))
+                    plot.append(NoEscape(r'\addplot[draw=blue, fill=blue!30, thick] coordinates {' + tikz_coords(x_clean, y_clean) + r'} \closedcycle;'))
 
         with doc.create(Subsection('Bending Moment Diagram')):
             with doc.create(TikZ()) as tikz:
@@ -245,16 +320,26 @@ def generate_pdf_doc(df, analysis_results, image_path, filename):
                     x_clean = analysis_results['x'][valid_indices]
                     y_clean = analysis_results['moment'][valid_indices]
                     
-                    coords = [f"({x:.3f},{y:.3f})" for x, y in zip(x_clean, y_clean)]
-                    plot.append(NoEscape(r'\addplot[draw=red, fill=red!30, thick] coordinates {' + " ".join(coords) + r'} \closedcycle;'))
+                    plot.append(NoEscape(r'\addplot[draw=red, fill=red!30, thick] coordinates {' + tikz_coords(x_clean, y_clean) + r'} \closedcycle;'))
 
-    doc.generate_pdf(filename, clean_tex=True)
+    # No \tableofcontents (the report has three fixed sections), so a single
+    # pdflatex pass is enough; skip latexmk's rerun loop and stop on the first error.
+    doc.generate_pdf(filename, clean_tex=True, compiler='pdflatex',
+                     compiler_args=['-halt-on-error'])
     return f"{filename}.pdf"
 
 # ==========================================
 # PART 4: FLASK ROUTES
 # ==========================================
 
+# Buffer size used when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+@app.errorhandler(413)
+def handle_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"error": f"Upload too large. Maximum size is {limit_mb} MB."}), 413
+
 @app.route('/generate', methods=['POST'])
 def handle_generation():
     if not shutil.which("pdflatex"):
@@ -265,56 +350,72 @@ def handle_generation():
             return jsonify({"error": "No file uploaded"}), 400
 
         unique_id = str(uuid.uuid4())[:8]
-        # Keep original extension or detect it
         file_obj = request.files['excel_file']
-        orig_name = file_obj.filename
-        ext = '.csv' if orig_name.lower().endswith('.csv') else '.xlsx'
-        
-        excel_path = f"temp_data_{unique_id}{ext}"
-        image_path = f"temp_beam_{unique_id}.png"
         output_filename = f"Report_{unique_id}"
 
-        file_obj.save(excel_path)
-        
-        image_file = request.files.get('image_file')
-        if image_file:
-            image_file.save(image_path)
-        else:
-            create_default_image(image_path)
+        # Intermediate files live in a temp dir that is removed on every exit path
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # load_data sniffs the format from the content, so the name is neutral
+            excel_path = os.path.join(temp_dir, "upload.dat")
 
-        # 3. Process Data
-        df = load_data(excel_path)
-        if df.empty:
-            return jsonify({"error": "File is empty or unreadable"}), 400
+            with open(excel_path, 'wb') as f:
+                shutil.copyfileobj(file_obj.stream, f, length=UPLOAD_CHUNK_SIZE)
+            
+            image_file = request.files.get('image_file')
+            if image_file:
+                image_path = os.path.join(temp_dir, "temp_beam.png")
+                with open(image_path, 'wb') as f:
+                    shutil.copyfileobj(image_file.stream, f, length=UPLOAD_CHUNK_SIZE)
+            else:
+                image_path = default_image_path()
 
-        # Validate we have enough data to do SOMETHING
-        cols = [c.lower() for c in df.columns]
-        has_load_cols = 'position (m)' in df.columns and 'load (kn)' in df.columns
-        has_result_cols = 'shear' in df.columns and 'moment' in df.columns
-        
-        if not (has_load_cols or has_result_cols):
-             found_cols = ", ".join(df.columns.tolist())
-             try:
-                os.remove(excel_path)
-                os.remove(image_path)
-             except: pass
-             return jsonify({
-                "error": f"Columns not recognized.\nNeed: [Position, Load] OR [x, Shear, Moment].\nFound: [{found_cols}]"
-            }), 400
-        
-        # 4. Analyze
-        analyzer = BeamAnalyzer(df)
-        
-        # 5. Generate PDF
-        pdf_path = generate_pdf_doc(df, analyzer.results, image_path, output_filename)
-        
-        try:
-            os.remove(excel_path)
-            os.remove(image_path)
-        except: pass
+            # 3. Process Data
+            try:
+                df = load_data(excel_path)
+            except ColumnClashError as e:
+                return jsonify({"error": str(e)}), 400
+            if df.empty:
+                return jsonify({"error": "File is empty or unreadable"}), 400
+
+            # Validate we have enough data to do SOMETHING
+            cols = set(map(str.lower, df.columns))
+            has_load_cols = {'position (m)', 'load (kn)'}.issubset(cols)
+            has_result_cols = {'shear', 'moment'}.issubset(cols)
+            
+            if not (has_load_cols or has_result_cols):
+                found_cols = ", ".join(df.columns.tolist())
+                return jsonify({
+                    "error": f"Columns not recognized.\nNeed: [Position, Load] OR [x, Shear, Moment].\nFound: [{found_cols}]"
+                }), 400
+
+            # The columns used in the analysis must be purely numeric
+            numeric_cols = ['x', 'shear', 'moment'] if has_result_cols else ['Position (m)', 'Load (kN)']
+            for col in numeric_cols:
+                if col not in df.columns or pd.api.types.is_numeric_dtype(df[col]):
+                    continue
+                values = pd.to_numeric(df[col], errors='coerce')
+                bad = df[col][values.isna() & df[col].notna()]
+                if not bad.empty:
+                    return jsonify({
+                        "error": f"Non-numeric value '{bad.iloc[0]}' in column '{col}' (row {bad.index[0] + 1})."
+                    }), 400
+            
+            # 4. Analyze
+            analyzer = BeamAnalyzer(df)
+            
+            # 5. Generate PDF
+            pdf_path = generate_pdf_doc(df, analyzer.results, image_path,
+                                        os.path.join(temp_dir, output_filename))
+
+            # Hold the PDF in memory so it goes away with the temp dir
+            with open(pdf_path, 'rb') as f:
+                pdf_bytes = io.BytesIO(f.read())
 
-        return send_file(pdf_path, as_attachment=True)
+        return send_file(pdf_bytes, mimetype='application/pdf', as_attachment=True,
+                         download_name=f"{output_filename}.pdf")
 
+    except RequestEntityTooLarge:
+        raise  # answered by handle_too_large
     except Exception as e:
         print("---------------- SERVER ERROR ----------------")
         traceback.print_exc()
@@ -322,5 +423,7 @@ def handle_generation():
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
+    # Development server only; use wsgi.py with gunicorn/waitress in production.
+    # Set FLASK_DEBUG=1 to get the debugger and reloader back.
     print("Starting Flask Server on port 5000...")
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', port=5000)
\ No newline at end of file
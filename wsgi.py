@@ -0,0 +1,8 @@
+"""WSGI entry point for running the report server under a production server.
+
+Linux/Mac:  gunicorn --preload -w 4 -k gthread --threads 2 wsgi:app
+Windows:    waitress-serve --port=5000 --threads=8 wsgi:app
+"""
+from beam_analysis_report import app
+
+__all__ = ["app"]